@@ -1,14 +1,24 @@
 import firebase_admin
 from firebase_admin import credentials, firestore, db
 import paho.mqtt.client as mqtt
-import json
-import csv
+import orjson
+import msgpack
 from datetime import datetime, timedelta
 import threading
+from concurrent.futures import ThreadPoolExecutor
+import queue
 import time
+import math
 import os
-from collections import defaultdict
+import sys
+import signal
+import logging
+import logging.handlers
 import statistics
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 
 # Firebase Configuration
 cred = credentials.Certificate('serviceAccountKey.json')
@@ -25,11 +35,44 @@ MQTT_PORT = 1883
 MQTT_TOPIC = "washroom/hygiene/data"
 MQTT_CLIENT_ID = "hygiene_backend_processor"
 
+# Compact payload keys accepted from sensor nodes, expanded on receipt
+KEY_MAP = {
+    'wid': 'washroom_id',
+    'aq': 'air_quality',
+    'fm': 'floor_moisture',
+    'hu': 'humidity',
+    'te': 'temperature',
+    'fc': 'footfall_count',
+    'ty': 'type'
+}
+
 # System Configuration
 HYGIENE_THRESHOLD = 50  # Alert if below this
 DECAY_RATE = 0.5  # Score decay per hour without cleaning
 MAX_DECAY_HOURS = 8
 CSV_LOG_DIR = "hygiene_logs"
+READING_LOG_FILE = os.path.join(CSV_LOG_DIR, "readings.log")
+READING_LOG_BUFFER = 1000  # Records held in memory before a file flush
+READING_LOG_MAX_BYTES = 10 * 1024 * 1024
+READING_LOG_BACKUPS = 5
+LOG_BATCH_SIZE = 500  # Firestore caps a batched write at 500 operations
+LOG_FLUSH_INTERVAL = 1.0  # Seconds before a partial batch is committed
+LOG_COMMIT_CONCURRENCY = 4  # Batched Firestore commits allowed in flight at once
+LOG_COMMIT_RETRIES = 3  # Attempts per batch before its logs are written one by one
+LOG_MAX_REQUEUES = 3  # Times a log that could not be written is requeued before it is dropped
+RTDB_FLUSH_INTERVAL = 0.25  # Seconds between multi-path realtime DB updates
+RTDB_KEY_FORBIDDEN = frozenset('.#$[]/')  # Characters a realtime DB key may not contain
+SCORE_ONLY_DELTA = 1.0  # Score change below which only the score is re-sent
+WASHROOM_CAPACITY = 1024  # Initial size of the per-washroom state arrays, doubled when full
+CONFIG_CACHE_FILE = "configs.json"
+CONFIG_SAVE_INTERVAL = 5  # Seconds between background saves of a changed config cache
+INBOUND_QUEUE_SIZE = 10000  # Per worker; oldest MQTT payloads are dropped beyond this
+INBOUND_BATCH_SIZE = 256  # Max readings scored together by one worker
+PROCESSING_WORKERS = 4  # Each washroom is always handled by the same worker
+NOTIFICATION_WORKERS = 4  # Threads pushing cleaner notifications to the realtime DB
+DASHBOARD_INTERVAL = 10  # Minimum seconds between dashboard redraws
+CSV_PAGE_SIZE = 1000  # Firestore documents fetched per page during CSV export
+CONFIG_REFRESH_INTERVAL = 600  # Re-fetch cached washroom configs every 10 minutes
 
 # Adaptive Weighting Profiles
 WEIGHT_PROFILES = {
@@ -63,17 +106,63 @@ WEIGHT_PROFILES = {
     }
 }
 
+# Column order for vectorized scoring: (sensor field, default when missing)
+SENSOR_DEFAULTS = (
+    ('air_quality', 50),
+    ('floor_moisture', 30),
+    ('humidity', 50),
+    ('temperature', 23),
+    ('footfall_count', 0)
+)
+COMPONENTS = ('air_quality', 'floor_moisture', 'humidity', 'temperature', 'footfall_density')
+
+# Weight profiles as arrays ordered like COMPONENTS, built once at import
+WEIGHT_ARRAYS = {
+    profile: np.array([weights[c] for c in COMPONENTS], dtype=np.float64)
+    for profile, weights in WEIGHT_PROFILES.items()
+}
+
+# Anomaly (type, severity, message) by bit position in detect_anomalies
+ANOMALY_RULES = (
+    ('ODOR_SPIKE', 'HIGH', 'Severe odor/ammonia levels detected'),
+    ('MOISTURE_ALERT', 'HIGH', 'Wet floor or potential leakage detected'),
+    ('TEMPERATURE_ANOMALY', 'MEDIUM', 'Unusual temperature: {}°C'),
+    ('HIGH_USAGE', 'MEDIUM', 'High usage detected, cleaning recommended')
+)
+
+# Daily log columns, the Firestore field each one is read from, and its type
+CSV_COLUMNS = (
+    ('timestamp', 'timestamp', pa.string()),
+    ('washroom_id', 'washroom_id', pa.string()),
+    ('final_score', 'final_score', pa.float64()),
+    ('base_score', 'base_score', pa.float64()),
+    ('air_quality', 'component_scores.air_quality', pa.float64()),
+    ('floor_moisture', 'component_scores.floor_moisture', pa.float64()),
+    ('humidity', 'component_scores.humidity', pa.float64()),
+    ('temperature', 'component_scores.temperature', pa.float64()),
+    ('footfall_count', 'sensor_data.footfall_count', pa.int64()),
+    ('anomalies_count', 'anomalies_count', pa.int64()),
+    ('profile', 'profile', pa.string())
+)
+CSV_SCHEMA = pa.schema([(column, column_type) for column, _, column_type in CSV_COLUMNS])
+
+# Per-reading log, configured by BackendProcessor.setup_reading_log
+reading_log = logging.getLogger('hygiene.readings')
+
 # Washroom Configuration (stored in database, cached here)
 washroom_configs = {}
-last_cleaning_times = {}
-last_scores = {}
-anomaly_buffer = defaultdict(list)
+
+# Per-washroom state in arrays indexed by a dense slot assigned on first sight
+washroom_slots = {}
+washroom_ids = []
+last_cleaning_times = np.full(WASHROOM_CAPACITY, np.nan)  # time.monotonic(), NaN if never cleaned
+last_scores = np.full(WASHROOM_CAPACITY, np.nan, dtype=np.float32)
 
 class HygieneScoreEngine:
-    def __init__(self, washroom_id, profile='public'):
-        self.washroom_id = washroom_id
+    def __init__(self, profile='public'):
         self.profile = profile
         self.weights = WEIGHT_PROFILES.get(profile, WEIGHT_PROFILES['public'])
+        self.weights_arr = WEIGHT_ARRAYS.get(profile, WEIGHT_ARRAYS['public'])
         
     def calculate_component_scores(self, data):
         """Convert raw sensor values to 0-100 scores (higher is better)"""
@@ -113,6 +202,32 @@ class HygieneScoreEngine:
         
         return scores
     
+    @staticmethod
+    def calculate_component_scores_batch(data_array):
+        """Vectorized calculate_component_scores over rows ordered as SENSOR_DEFAULTS"""
+        air_quality = data_array[:, 0]
+        moisture = data_array[:, 1]
+        humidity = data_array[:, 2]
+        temperature = data_array[:, 3]
+        footfall = data_array[:, 4]
+        
+        scores = np.empty_like(data_array)
+        scores[:, 0] = np.maximum(0, 100 - air_quality)
+        scores[:, 1] = np.maximum(0, 100 - moisture)
+        # Comfort bands are branch-free; they match the scalar formulas to within
+        # floating-point rounding (1e-9), not bit for bit
+        scores[:, 2] = np.maximum(0, 100 - np.maximum(0, 40 - humidity) * 2.5
+                                  - np.maximum(0, humidity - 60) * 2)
+        scores[:, 3] = np.maximum(0, 100 - np.maximum(0, 20 - temperature) * 5
+                                  - np.maximum(0, temperature - 26) * 5)
+        scores[:, 4] = np.maximum(0, 100 - footfall)
+        
+        return scores
+    
+    def calculate_weighted_scores_batch(self, component_array):
+        """Weighted hygiene scores for rows ordered as COMPONENTS"""
+        return np.round(component_array @ self.weights_arr, 2)
+    
     def calculate_weighted_score(self, component_scores):
         """Calculate weighted hygiene score"""
         total_score = 0
@@ -123,11 +238,11 @@ class HygieneScoreEngine:
         return round(total_score, 2)
     
     def apply_time_decay(self, base_score, last_cleaned):
-        """Apply decay based on time since last cleaning"""
-        if not last_cleaned:
+        """Apply decay based on time since last cleaning, a time.monotonic() value"""
+        if last_cleaned is None or math.isnan(last_cleaned):
             return base_score
         
-        hours_since_cleaning = (datetime.now() - last_cleaned).total_seconds() / 3600
+        hours_since_cleaning = (time.monotonic() - last_cleaned) / 3600
         
         if hours_since_cleaning <= 1:
             return base_score
@@ -138,60 +253,85 @@ class HygieneScoreEngine:
         decayed_score = max(0, base_score - decay_amount)
         return round(decayed_score, 2)
     
+    @staticmethod
+    def apply_time_decay_batch(base_scores, hours_since_cleaning):
+        """Vectorized apply_time_decay; NaN hours means never cleaned"""
+        decay_hours = np.minimum(hours_since_cleaning - 1, MAX_DECAY_HOURS)
+        decayed_scores = np.round(np.maximum(0, base_scores - decay_hours * DECAY_RATE), 2)
+        return np.where(hours_since_cleaning > 1, decayed_scores, base_scores)
+    
     def detect_anomalies(self, data, component_scores):
         """Detect various anomalies"""
-        anomalies = []
-        
-        # High air quality reading (poor air)
-        if data.get('air_quality', 0) > 70:
-            anomalies.append({
-                'type': 'ODOR_SPIKE',
-                'severity': 'HIGH',
-                'message': 'Severe odor/ammonia levels detected',
-                'value': data.get('air_quality')
-            })
+        air_quality = data.get('air_quality', 0)
+        moisture = data.get('floor_moisture', 0)
+        temp = data.get('temperature', 23)
+        footfall = data.get('footfall_count', 0)
         
-        # High floor moisture (leak or water overflow)
-        if data.get('floor_moisture', 0) > 60:
-            anomalies.append({
-                'type': 'MOISTURE_ALERT',
-                'severity': 'HIGH',
-                'message': 'Wet floor or potential leakage detected',
-                'value': data.get('floor_moisture')
-            })
+        # One bit per ANOMALY_RULES entry: poor air, wet floor or leak, extreme
+        # temperature, high footfall without air quality recovery
+        mask = ((air_quality > 70)
+                | (moisture > 60) << 1
+                | (temp < 10 or temp > 35) << 2
+                | (footfall > 50 and component_scores.get('air_quality', 100) < 40) << 3)
         
-        # Extreme temperature
-        temp = data.get('temperature', 23)
-        if temp < 10 or temp > 35:
-            anomalies.append({
-                'type': 'TEMPERATURE_ANOMALY',
-                'severity': 'MEDIUM',
-                'message': f'Unusual temperature: {temp}°C',
-                'value': temp
-            })
+        if not mask:
+            return []
         
-        # High footfall without score recovery (cleaning needed)
-        if data.get('footfall_count', 0) > 50 and component_scores.get('air_quality', 100) < 40:
+        values = (air_quality, moisture, temp, footfall)
+        anomalies = []
+        while mask:
+            bit = (mask & -mask).bit_length() - 1
+            anomaly_type, severity, message = ANOMALY_RULES[bit]
             anomalies.append({
-                'type': 'HIGH_USAGE',
-                'severity': 'MEDIUM',
-                'message': 'High usage detected, cleaning recommended',
-                'value': data.get('footfall_count')
+                'type': anomaly_type,
+                'severity': severity,
+                'message': message.format(values[bit]),
+                'value': values[bit]
             })
+            mask &= mask - 1
         
         return anomalies
 
+# Engines hold no per-washroom state, so one per profile is shared
+ENGINES = {profile: HygieneScoreEngine(profile) for profile in WEIGHT_PROFILES}
+
 class BackendProcessor:
     def __init__(self):
         self.mqtt_client = mqtt.Client(MQTT_CLIENT_ID)
         self.mqtt_client.on_connect = self.on_mqtt_connect
         self.mqtt_client.on_message = self.on_mqtt_message
         self.running = True
+        self._inbound = [queue.Queue(maxsize=INBOUND_QUEUE_SIZE) for _ in range(PROCESSING_WORKERS)]
+        self.dropped_messages = 0
+        self._scores_changed = threading.Event()
+        self._notification_pool = ThreadPoolExecutor(max_workers=NOTIFICATION_WORKERS)
+        self._log_queue = queue.Queue()
+        self._commit_pool = ThreadPoolExecutor(max_workers=LOG_COMMIT_CONCURRENCY)
+        self._commit_slots = threading.BoundedSemaphore(LOG_COMMIT_CONCURRENCY)
+        self._rtdb_pending = {}
+        self._rtdb_fields = {}
+        self._last_full_states = {}
+        self._rtdb_lock = threading.Lock()
+        self._config_lock = threading.Lock()
+        self._configs_dirty = threading.Event()
+        self._slot_lock = threading.Lock()
         
         # Create CSV log directory
         os.makedirs(CSV_LOG_DIR, exist_ok=True)
+        self.setup_reading_log()
+        
+        # Warm the config cache from the previous run
+        self.load_config_cache()
         
         # Start background tasks
+        self._workers = [threading.Thread(target=self.message_worker, args=(inbound,), daemon=True)
+                         for inbound in self._inbound]
+        self._log_writer = threading.Thread(target=self.firestore_log_writer, daemon=True)
+        self._rtdb_writer = threading.Thread(target=self.realtime_db_writer, daemon=True)
+        for thread in self._workers + [self._log_writer, self._rtdb_writer]:
+            thread.start()
+        threading.Thread(target=self.config_refresher, daemon=True).start()
+        threading.Thread(target=self.config_cache_saver, daemon=True).start()
         threading.Thread(target=self.daily_csv_logger, daemon=True).start()
         threading.Thread(target=self.console_dashboard, daemon=True).start()
         
@@ -201,53 +341,177 @@ class BackendProcessor:
         client.subscribe("washroom/+/heartbeat")
         
     def on_mqtt_message(self, client, userdata, msg):
+        """Decode the payload and hand it to its washroom's worker"""
+        received_at = time.time()
         try:
-            payload = json.loads(msg.payload.decode())
-            
-            if 'type' in payload and payload['type'] == 'heartbeat':
-                self.handle_heartbeat(payload)
-            else:
-                self.process_sensor_data(payload)
-                
+            payload = self.decode_payload(msg.payload)
+            # A washroom always maps to the same worker, so its readings stay in order
+            inbound = self._inbound[hash(str(payload.get('washroom_id'))) % PROCESSING_WORKERS]
         except Exception as e:
             print(f"✗ Error processing message: {e}")
+            return
+        
+        while True:
+            try:
+                inbound.put_nowait((received_at, payload))
+                return
+            except queue.Full:
+                # Drop the oldest payload to make room for the newest
+                try:
+                    inbound.get_nowait()
+                    self.dropped_messages += 1
+                except queue.Empty:
+                    pass
     
-    def handle_heartbeat(self, data):
+    def message_worker(self, inbound):
+        """Drain one worker's queue and process sensor readings in batches"""
+        while self.running:
+            try:
+                items = [inbound.get(timeout=1)]
+            except queue.Empty:
+                continue
+            
+            while len(items) < INBOUND_BATCH_SIZE:
+                try:
+                    items.append(inbound.get_nowait())
+                except queue.Empty:
+                    break
+            
+            self.process_inbound_items(items)
+    
+    def process_inbound_items(self, items):
+        """Handle heartbeats and score the sensor readings among queued items"""
+        readings = []
+        received_times = []
+        for received_at, payload in items:
+            try:
+                if 'type' in payload and payload['type'] == 'heartbeat':
+                    self.handle_heartbeat(payload, received_at)
+                else:
+                    readings.append(payload)
+                    received_times.append(received_at)
+                    
+            except Exception as e:
+                print(f"✗ Error processing message: {e}")
+        
+        if readings:
+            try:
+                self.process_sensor_batch(readings, received_times)
+            except Exception as e:
+                print(f"✗ Error processing {len(readings)} readings: {e}")
+    
+    def decode_payload(self, raw):
+        """Decode a JSON or MessagePack payload, expanding compact keys"""
+        # MessagePack maps start with a fixmap (0x80-0x8f), map16 or map32 byte
+        if raw and (0x80 <= raw[0] <= 0x8f or raw[0] in (0xde, 0xdf)):
+            payload = msgpack.unpackb(raw, raw=False)
+        else:
+            payload = orjson.loads(raw)
+        
+        return {KEY_MAP.get(key, key): value for key, value in payload.items()}
+    
+    def handle_heartbeat(self, data, received_at):
         """Process heartbeat to detect sensor failures"""
         washroom_id = data.get('washroom_id')
+        if not self.valid_washroom_id(washroom_id):
+            print(f"✗ Invalid washroom_id in heartbeat: {washroom_id!r}")
+            return
         
         # Update last heartbeat time
-        realtime_db.child(f'washrooms/{washroom_id}/last_heartbeat').set({
-            'timestamp': datetime.now().isoformat(),
+        self.queue_realtime_update(f'washrooms/{washroom_id}/last_heartbeat', {
+            'timestamp': datetime.fromtimestamp(received_at).isoformat(),
             'uptime_ms': data.get('uptime_ms'),
             'free_heap': data.get('free_heap'),
             'wifi_connected': data.get('wifi_connected')
         })
         
-    def process_sensor_data(self, data):
-        """Main processing pipeline"""
-        washroom_id = data.get('washroom_id')
+    def process_sensor_batch(self, readings, received_times):
+        """Main processing pipeline, scoring all readings in one vectorized pass"""
+        # Validate each reading on its own so one bad message only loses itself
+        valid = []
+        sensor_rows = []
+        slots = []
+        profiles = []
+        timestamps = []
+        engines = {}
+        for data, received_at in zip(readings, received_times):
+            washroom_id = data.get('washroom_id')
+            if not washroom_id:
+                print("✗ Missing washroom_id in data")
+                continue
+            if not self.valid_washroom_id(washroom_id):
+                print(f"✗ Invalid washroom_id: {washroom_id!r}")
+                continue
+            
+            row = [data.get(field, default) for field, default in SENSOR_DEFAULTS]
+            if not all(self.valid_sensor_value(value) for value in row):
+                print(f"✗ Invalid sensor values from {washroom_id}: {row}")
+                continue
+            
+            try:
+                config = self.get_washroom_config(washroom_id)
+            except Exception as e:
+                print(f"✗ Could not load config for {washroom_id}: {e}")
+                continue
+            
+            slot = self.washroom_slot(washroom_id)
+            
+            # Look up the shared score engine for the reading's profile
+            profile = config.get('profile', 'public')
+            engines[profile] = ENGINES.get(profile, ENGINES['public'])
+            
+            valid.append(data)
+            sensor_rows.append(row)
+            slots.append(slot)
+            profiles.append(profile)
+            timestamps.append(datetime.fromtimestamp(received_at).isoformat())
         
-        if not washroom_id:
-            print("✗ Missing washroom_id in data")
+        if not valid:
             return
         
-        # Get washroom configuration
-        config = self.get_washroom_config(washroom_id)
-        profile = config.get('profile', 'public')
-        
-        # Initialize score engine
-        engine = HygieneScoreEngine(washroom_id, profile)
-        
         # Calculate component scores
-        component_scores = engine.calculate_component_scores(data)
+        data_array = np.array(sensor_rows, dtype=np.float64)
+        component_array = HygieneScoreEngine.calculate_component_scores_batch(data_array)
         
-        # Calculate base weighted score
-        base_score = engine.calculate_weighted_score(component_scores)
+        # Calculate base weighted scores
+        profile_array = np.array(profiles)
+        base_scores = np.empty(len(valid))
+        for profile, engine in engines.items():
+            rows = profile_array == profile
+            base_scores[rows] = engine.calculate_weighted_scores_batch(component_array[rows])
         
         # Apply time decay
-        last_cleaned = last_cleaning_times.get(washroom_id)
-        final_score = engine.apply_time_decay(base_score, last_cleaned)
+        hours_since_cleaning = (time.monotonic() - last_cleaning_times[slots]) * (1 / 3600.0)
+        final_scores = HygieneScoreEngine.apply_time_decay_batch(base_scores, hours_since_cleaning)
+        
+        for i, data in enumerate(valid):
+            try:
+                self.finish_sensor_reading(data, profiles[i], engines[profiles[i]], slots[i],
+                                           dict(zip(COMPONENTS, component_array[i].tolist())),
+                                           float(base_scores[i]), float(final_scores[i]), timestamps[i])
+            except Exception as e:
+                print(f"✗ Error processing reading from {data['washroom_id']}: {e}")
+    
+    @staticmethod
+    def valid_washroom_id(washroom_id):
+        """True if washroom_id can be used as a realtime DB key and a Firestore document ID"""
+        return (isinstance(washroom_id, str) and bool(washroom_id)
+                and not (washroom_id.startswith('__') and washroom_id.endswith('__'))
+                and not any(c in RTDB_KEY_FORBIDDEN or ord(c) < 32 or ord(c) == 127
+                            for c in washroom_id))
+    
+    @staticmethod
+    def valid_sensor_value(value):
+        """True for a finite int or float that Firestore can store as-is"""
+        # bool is an int subclass, and MessagePack payloads can carry NaN, inf
+        # and integers wider than Firestore's 64 bits
+        return (isinstance(value, (int, float)) and not isinstance(value, bool)
+                and abs(value) < 2 ** 63 and math.isfinite(value))
+    
+    def finish_sensor_reading(self, data, profile, engine, slot, component_scores, base_score,
+                              final_score, timestamp):
+        """Anomaly checks, storage and alerts for one scored reading"""
+        washroom_id = data['washroom_id']
         
         # Detect anomalies
         anomalies = engine.detect_anomalies(data, component_scores)
@@ -255,13 +519,14 @@ class BackendProcessor:
         # Prepare result
         result = {
             'washroom_id': washroom_id,
-            'timestamp': datetime.now().isoformat(),
-            'sensor_data': data,
+            'timestamp': timestamp,
+            'sensor_data': self.logged_sensor_data(data),
             'component_scores': component_scores,
             'base_score': base_score,
             'final_score': final_score,
             'decay_applied': base_score - final_score,
             'anomalies': anomalies,
+            'anomalies_count': len(anomalies),
             'profile': profile
         }
         
@@ -272,56 +537,298 @@ class BackendProcessor:
         self.check_alerts(result)
         
         # Update cache
-        last_scores[washroom_id] = final_score
-        
-        # Console output
-        print(f"\n{'='*60}")
-        print(f"🚻 Washroom: {washroom_id} | Profile: {profile}")
-        print(f"📊 Hygiene Score: {final_score}% (Base: {base_score}%)")
-        print(f"🔍 Components: AQ={component_scores['air_quality']:.1f}% | "
-              f"Moist={component_scores['floor_moisture']:.1f}% | "
-              f"Humid={component_scores['humidity']:.1f}%")
+        score = np.float32(final_score)
+        with self._slot_lock:
+            changed = last_scores[slot] != score
+            if changed:
+                last_scores[slot] = score
+        if changed:
+            self._scores_changed.set()
+        
+        # Reading log (arguments are only formatted if a handler emits the record)
+        reading_log.info("washroom=%s profile=%s score=%.2f base=%.2f aq=%.1f moist=%.1f humid=%.1f",
+                         washroom_id, profile, final_score, base_score,
+                         component_scores['air_quality'], component_scores['floor_moisture'],
+                         component_scores['humidity'])
         if anomalies:
-            print(f"⚠️  Anomalies: {len(anomalies)}")
-            for anomaly in anomalies:
-                print(f"   - {anomaly['type']}: {anomaly['message']}")
-        print(f"{'='*60}\n")
+            reading_log.warning("washroom=%s anomalies=%d %s", washroom_id, len(anomalies),
+                                "; ".join(f"{a['type']}: {a['message']}" for a in anomalies))
+    
+    def logged_sensor_data(self, data):
+        """The validated fields of a reading, leaving out anything Firestore might reject"""
+        sensor_data = {'washroom_id': data['washroom_id']}
+        for field, _ in SENSOR_DEFAULTS:
+            if field in data:
+                sensor_data[field] = data[field]
+        return sensor_data
+    
+    def setup_reading_log(self):
+        """Buffer per-reading log lines in memory and flush them to a rotating file"""
+        file_handler = logging.handlers.RotatingFileHandler(
+            READING_LOG_FILE, maxBytes=READING_LOG_MAX_BYTES, backupCount=READING_LOG_BACKUPS)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        
+        # Anomalies (WARNING) flush the buffer straight away
+        reading_log.addHandler(logging.handlers.MemoryHandler(
+            READING_LOG_BUFFER, flushLevel=logging.WARNING, target=file_handler))
+        
+        # Echo to the console only when someone is watching it
+        if sys.stdout.isatty():
+            reading_log.addHandler(logging.StreamHandler(sys.stdout))
+        
+        reading_log.setLevel(logging.INFO)
+        reading_log.propagate = False
+        
+    def washroom_slot(self, washroom_id):
+        """Dense index into the per-washroom state arrays"""
+        slot = washroom_slots.get(washroom_id)
+        if slot is not None:
+            return slot
+        
+        with self._slot_lock:
+            slot = washroom_slots.get(washroom_id)
+            if slot is None:
+                slot = len(washroom_ids)
+                if slot == len(last_scores):
+                    self.grow_state_arrays()
+                washroom_ids.append(washroom_id)
+                washroom_slots[washroom_id] = slot
+            return slot
+    
+    def grow_state_arrays(self):
+        """Double the per-washroom state arrays; caller holds _slot_lock"""
+        global last_scores, last_cleaning_times
         
+        extra = len(last_scores)
+        last_scores = np.concatenate([last_scores, np.full(extra, np.nan, dtype=np.float32)])
+        last_cleaning_times = np.concatenate([last_cleaning_times, np.full(extra, np.nan)])
+    
     def get_washroom_config(self, washroom_id):
         """Get washroom configuration from cache or database"""
-        if washroom_id not in washroom_configs:
-            doc = firestore_db.collection('washroom_configs').document(washroom_id).get()
-            if doc.exists:
-                washroom_configs[washroom_id] = doc.to_dict()
-            else:
-                # Create default config
-                default_config = {
-                    'profile': 'public',
-                    'threshold': HYGIENE_THRESHOLD,
-                    'name': f'Washroom {washroom_id}',
-                    'location': 'Unknown'
-                }
-                firestore_db.collection('washroom_configs').document(washroom_id).set(default_config)
-                washroom_configs[washroom_id] = default_config
-        
-        return washroom_configs[washroom_id]
+        config = washroom_configs.get(washroom_id)
+        if config is not None:
+            return config
+        
+        doc = firestore_db.collection('washroom_configs').document(washroom_id).get()
+        if doc.exists:
+            config = doc.to_dict()
+        else:
+            # Create default config
+            config = {
+                'profile': 'public',
+                'threshold': HYGIENE_THRESHOLD,
+                'name': f'Washroom {washroom_id}',
+                'location': 'Unknown'
+            }
+            firestore_db.collection('washroom_configs').document(washroom_id).set(config)
+        
+        washroom_configs[washroom_id] = config
+        self._configs_dirty.set()
+        return config
+    
+    def load_config_cache(self):
+        """Load washroom configs persisted by a previous run"""
+        if not os.path.exists(CONFIG_CACHE_FILE):
+            return
+        
+        try:
+            with open(CONFIG_CACHE_FILE, 'rb') as f:
+                washroom_configs.update(orjson.loads(f.read()))
+            print(f"✓ Loaded {len(washroom_configs)} cached washroom configs")
+        except Exception as e:
+            print(f"✗ Could not load config cache: {e}")
+    
+    def save_config_cache(self):
+        """Persist washroom configs so restarts skip cold Firestore reads"""
+        with self._config_lock:
+            try:
+                tmp_file = CONFIG_CACHE_FILE + '.tmp'
+                with open(tmp_file, 'wb') as f:
+                    f.write(orjson.dumps(dict(washroom_configs), default=str))
+                os.replace(tmp_file, CONFIG_CACHE_FILE)
+            except Exception as e:
+                print(f"✗ Could not save config cache: {e}")
+    
+    def config_cache_saver(self):
+        """Persist the config cache in the background, at most once per interval"""
+        while self.running:
+            time.sleep(CONFIG_SAVE_INTERVAL)
+            
+            if self._configs_dirty.is_set():
+                self._configs_dirty.clear()
+                self.save_config_cache()
+    
+    def config_refresher(self):
+        """Periodically re-fetch all cached configs in a single RPC"""
+        while self.running:
+            time.sleep(CONFIG_REFRESH_INTERVAL)
+            
+            if not washroom_configs:
+                continue
+            
+            try:
+                configs_ref = firestore_db.collection('washroom_configs')
+                refs = [configs_ref.document(washroom_id) for washroom_id in list(washroom_configs)]
+                for doc in firestore_db.get_all(refs):
+                    if doc.exists:
+                        washroom_configs[doc.id] = doc.to_dict()
+                self._configs_dirty.set()
+            except Exception as e:
+                print(f"✗ Config refresh error: {e}")
     
     def store_in_firebase(self, result):
         """Store processed data in Firebase"""
         washroom_id = result['washroom_id']
         timestamp = result['timestamp']
         
-        # Store in Firestore (historical data)
-        firestore_db.collection('hygiene_logs').add(result)
+        # Queue for Firestore (historical data) with its requeue count, committed in batches
+        self._log_queue.put((0, result))
         
-        # Update real-time database (current state)
-        realtime_db.child(f'washrooms/{washroom_id}/current').set({
-            'score': result['final_score'],
-            'timestamp': timestamp,
-            'component_scores': result['component_scores'],
-            'anomalies': result['anomalies']
-        })
+        # Update real-time database (current state). While the score holds
+        # steady and nothing is anomalous, only the score and timestamp change.
+        current_path = f'washrooms/{washroom_id}/current'
+        score = result['final_score']
+        anomalies = result['anomalies']
+        last_full = self._last_full_states.get(washroom_id)
+        
+        if (last_full is not None and not anomalies and not last_full[1]
+                and abs(score - last_full[0]) < SCORE_ONLY_DELTA):
+            self.queue_realtime_fields(current_path, {
+                'score': score,
+                'timestamp': timestamp
+            })
+        else:
+            self._last_full_states[washroom_id] = (score, bool(anomalies))
+            self.queue_realtime_update(current_path, {
+                'score': score,
+                'timestamp': timestamp,
+                'component_scores': result['component_scores'],
+                'anomalies': anomalies
+            })
+        
+    def firestore_log_writer(self):
+        """Collect queued hygiene logs into batches and hand them off for commit"""
+        while self.running:
+            try:
+                items = [self._log_queue.get(timeout=LOG_FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            
+            # Collect until the batch is full or the flush interval elapses
+            deadline = time.time() + LOG_FLUSH_INTERVAL
+            while len(items) < LOG_BATCH_SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._log_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # Overlap commits, blocking collection once too many are in flight
+            self._commit_slots.acquire()
+            self._commit_pool.submit(self.background_log_commit, items)
+    
+    def background_log_commit(self, items):
+        """Commit a batch on the commit thread pool, requeueing logs that could not be written"""
+        try:
+            failed = self.commit_log_batch(items)
+            requeued = [(requeues + 1, result) for requeues, result in failed
+                        if requeues < LOG_MAX_REQUEUES]
+            if len(requeued) < len(failed):
+                print(f"✗ Dropped {len(failed) - len(requeued)} hygiene logs after "
+                      f"{LOG_MAX_REQUEUES} requeues")
+            if requeued:
+                print(f"✗ Requeueing {len(requeued)} hygiene logs")
+                for item in requeued:
+                    self._log_queue.put(item)
+        finally:
+            self._commit_slots.release()
+    
+    def commit_log_batch(self, items):
+        """Commit one batch of queued (requeues, result) logs; returns the items not written"""
+        logs_ref = firestore_db.collection('hygiene_logs')
+        
+        for attempt in range(1, LOG_COMMIT_RETRIES + 1):
+            try:
+                batch = firestore_db.batch()
+                for _, result in items:
+                    batch.set(logs_ref.document(), result)
+                batch.commit()
+                return []
+            except Exception as e:
+                print(f"✗ Firestore batch write failed ({len(items)} logs, "
+                      f"attempt {attempt}/{LOG_COMMIT_RETRIES}): {e}")
+                if attempt < LOG_COMMIT_RETRIES:
+                    time.sleep(2 ** (attempt - 1))
+        
+        # One rejected document fails the whole batch, so write them one by one
+        failed = []
+        for item in items:
+            try:
+                logs_ref.document().set(item[1])
+            except Exception as e:
+                failed.append(item)
+                error = e
         
+        if failed:
+            print(f"✗ {len(failed)} of {len(items)} hygiene logs failed to write: {error}")
+        return failed
+    
+    def queue_realtime_update(self, path, value):
+        """Stage a realtime DB write; newer values for a path replace older ones"""
+        with self._rtdb_lock:
+            self._rtdb_pending[path] = value
+            self._rtdb_fields.pop(path, None)
+    
+    def queue_realtime_fields(self, path, fields):
+        """Stage writes to individual children of path, leaving its other children intact"""
+        with self._rtdb_lock:
+            pending = self._rtdb_pending.get(path)
+            if pending is not None:
+                # A full write of path is already staged; fold the fields into it
+                pending.update(fields)
+            else:
+                self._rtdb_fields.setdefault(path, {}).update(fields)
+    
+    def realtime_db_writer(self):
+        """Flush staged realtime DB writes as one multi-path update"""
+        while self.running:
+            time.sleep(RTDB_FLUSH_INTERVAL)
+            self.flush_realtime_db()
+    
+    def flush_realtime_db(self):
+        """Send everything staged for the realtime DB in one update"""
+        with self._rtdb_lock:
+            if not self._rtdb_pending and not self._rtdb_fields:
+                return
+            pending, self._rtdb_pending = self._rtdb_pending, {}
+            fields, self._rtdb_fields = self._rtdb_fields, {}
+        
+        for path, values in fields.items():
+            for key, value in values.items():
+                pending[f'{path}/{key}'] = value
+        
+        try:
+            realtime_db.update(pending)
+            return
+        except Exception as e:
+            print(f"✗ Realtime DB update failed ({len(pending)} paths), retrying one by one: {e}")
+        
+        # Write each path alone so one rejected path cannot hold back the rest
+        failed = 0
+        for path, value in pending.items():
+            try:
+                realtime_db.update({path: value})
+            except Exception as e:
+                failed += 1
+                error = e
+        
+        if failed:
+            # Full current-state writes may have been lost; resend them next time
+            self._last_full_states.clear()
+            print(f"✗ Dropped {failed} of {len(pending)} realtime DB writes: {error}")
+    
     def check_alerts(self, result):
         """Check if alerts need to be triggered"""
         washroom_id = result['washroom_id']
@@ -331,23 +838,29 @@ class BackendProcessor:
         threshold = config.get('threshold', HYGIENE_THRESHOLD)
         
         if score < threshold:
-            self.send_cleaner_notification(washroom_id, score, result['anomalies'])
+            self.send_cleaner_notification(washroom_id, score, result['anomalies'], result['timestamp'])
     
-    def send_cleaner_notification(self, washroom_id, score, anomalies):
+    def send_cleaner_notification(self, washroom_id, score, anomalies, timestamp):
         """Send notification to cleaners"""
         notification = {
             'washroom_id': washroom_id,
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': timestamp,
             'type': 'HYGIENE_ALERT',
             'score': score,
             'message': f'Hygiene score dropped to {score}%. Immediate cleaning required.',
             'anomalies': anomalies
         }
         
-        # Store in Firebase for Flutter app to pick up
-        realtime_db.child(f'notifications/{washroom_id}').push(notification)
-        
-        print(f"🔔 ALERT SENT: Washroom {washroom_id} - Score: {score}%")
+        # Store in Firebase for Flutter app to pick up, off the processing thread
+        self._notification_pool.submit(self.push_notification, washroom_id, notification)
+    
+    def push_notification(self, washroom_id, notification):
+        """Push a notification; runs on the notification thread pool"""
+        try:
+            realtime_db.child(f'notifications/{washroom_id}').push(notification)
+            print(f"🔔 ALERT SENT: Washroom {washroom_id} - Score: {notification['score']}%")
+        except Exception as e:
+            print(f"✗ Failed to send alert for {washroom_id}: {e}")
     
     def daily_csv_logger(self):
         """Generate daily CSV logs"""
@@ -362,78 +875,184 @@ class BackendProcessor:
                 print(f"📅 Next CSV log generation in {sleep_seconds/3600:.1f} hours")
                 time.sleep(sleep_seconds)
                 
-                # Generate yesterday's log
-                yesterday = now.date() - timedelta(days=1)
-                self.generate_csv_log(yesterday)
-                
             except Exception as e:
                 print(f"✗ CSV logger error: {e}")
-                time.sleep(3600)  # Retry in 1 hour
+                continue
+            
+            # Generate yesterday's log, retrying the same date until it succeeds
+            yesterday = now.date() - timedelta(days=1)
+            while self.running:
+                try:
+                    self.generate_csv_log(yesterday)
+                    break
+                except Exception as e:
+                    print(f"✗ CSV log for {yesterday} failed: {e}")
+                    time.sleep(3600)  # Retry in 1 hour
     
-    def generate_csv_log(self, date):
-        """Generate CSV log for a specific date"""
-        print(f"📝 Generating CSV log for {date}")
-        
-        # Query Firestore for date range
+    def stream_hygiene_logs(self, date, field_paths):
+        """Yield a day's hygiene logs in pages, projected to field_paths"""
         start = datetime.combine(date, datetime.min.time())
         end = datetime.combine(date, datetime.max.time())
         
-        logs = firestore_db.collection('hygiene_logs')\
+        query = firestore_db.collection('hygiene_logs')\
             .where('timestamp', '>=', start.isoformat())\
             .where('timestamp', '<=', end.isoformat())\
-            .order_by('timestamp').stream()
-        
-        filename = f"{CSV_LOG_DIR}/hygiene_log_{date}.csv"
+            .order_by('timestamp')\
+            .select(field_paths)\
+            .limit(CSV_PAGE_SIZE)
         
-        with open(filename, 'w', newline='') as csvfile:
-            fieldnames = ['timestamp', 'washroom_id', 'final_score', 'base_score', 
-                         'air_quality', 'floor_moisture', 'humidity', 'temperature',
-                         'footfall_count', 'anomalies_count', 'profile']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
+        last = None
+        while True:
+            page_query = query.start_after(last) if last is not None else query
+            page = list(page_query.stream())
+            if page:
+                yield page
             
-            count = 0
-            for log in logs:
-                data = log.to_dict()
-                row = {
-                    'timestamp': data.get('timestamp'),
-                    'washroom_id': data.get('washroom_id'),
-                    'final_score': data.get('final_score'),
-                    'base_score': data.get('base_score'),
-                    'air_quality': data.get('component_scores', {}).get('air_quality'),
-                    'floor_moisture': data.get('component_scores', {}).get('floor_moisture'),
-                    'humidity': data.get('component_scores', {}).get('humidity'),
-                    'temperature': data.get('component_scores', {}).get('temperature'),
-                    'footfall_count': data.get('sensor_data', {}).get('footfall_count'),
-                    'anomalies_count': len(data.get('anomalies', [])),
-                    'profile': data.get('profile')
-                }
-                writer.writerow(row)
-                count += 1
-        
-        print(f"✓ CSV log generated: {filename} ({count} records)")
+            if len(page) < CSV_PAGE_SIZE:
+                break
+            last = page[-1]
+    
+    def generate_csv_log(self, date):
+        """Generate Parquet and gzipped CSV logs for a specific date"""
+        print(f"📝 Generating CSV log for {date}")
+        
+        def field(snapshot, path):
+            try:
+                return snapshot.get(path)
+            except KeyError:
+                return None
+        
+        # Values that do not fit their column's type are written as null
+        def to_float(value):
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return None
+        
+        def to_int(value):
+            number = to_float(value)
+            return int(number) if number is not None and number.is_integer() else None
+        
+        def to_str(value):
+            return None if value is None else str(value)
+        
+        casts = {pa.string(): to_str, pa.float64(): to_float, pa.int64(): to_int}
+        columns = [(column, path, casts[column_type]) for column, path, column_type in CSV_COLUMNS]
+        
+        parquet_file = f"{CSV_LOG_DIR}/hygiene_log_{date}.parquet"
+        filename = f"{CSV_LOG_DIR}/hygiene_log_{date}.csv.gz"
+        
+        # Write page by page into temporary files, renamed once the day is complete
+        count = 0
+        with pq.ParquetWriter(parquet_file + '.tmp', CSV_SCHEMA, compression='zstd') as parquet_writer, \
+                pa.CompressedOutputStream(filename + '.tmp', 'gzip') as csvfile, \
+                pa_csv.CSVWriter(csvfile, CSV_SCHEMA) as csv_writer:
+            for page in self.stream_hygiene_logs(date, [path for _, path, _ in CSV_COLUMNS]):
+                batch = pa.RecordBatch.from_pydict(
+                    {column: [cast(field(log, path)) for log in page] for column, path, cast in columns},
+                    schema=CSV_SCHEMA)
+                parquet_writer.write_batch(batch)
+                csv_writer.write_batch(batch)
+                count += batch.num_rows
+        
+        os.replace(parquet_file + '.tmp', parquet_file)
+        os.replace(filename + '.tmp', filename)
+        
+        print(f"✓ CSV log generated: {filename}, {parquet_file} ({count} records)")
     
     def console_dashboard(self):
-        """Live console dashboard"""
+        """Live console dashboard, redrawn only after scores change"""
+        last_render = 0
         while self.running:
-            time.sleep(10)
+            if not self._scores_changed.wait(timeout=DASHBOARD_INTERVAL):
+                continue
+            
+            # Coalesce bursts of updates into at most one redraw per interval
+            delay = last_render + DASHBOARD_INTERVAL - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._scores_changed.clear()
             
-            if last_scores:
-                print("\n" + "="*70)
-                print("📊 LIVE HYGIENE DASHBOARD")
-                print("="*70)
-                for washroom_id, score in last_scores.items():
-                    status = "🟢 GOOD" if score >= 70 else "🟡 FAIR" if score >= 50 else "🔴 POOR"
-                    print(f"{washroom_id}: {score}% {status}")
-                print("="*70 + "\n")
+            lines = ["", "="*70, "📊 LIVE HYGIENE DASHBOARD", "="*70]
+            with self._slot_lock:
+                scores = last_scores[:len(washroom_ids)].copy()
+            for status, rows in (("🟢 GOOD", scores >= 70),
+                                 ("🟡 FAIR", (scores >= 50) & (scores < 70)),
+                                 ("🔴 POOR", scores < 50)):
+                for slot in np.flatnonzero(rows):
+                    lines.append(f"{washroom_ids[slot]}: {round(float(scores[slot]), 2)}% {status}")
+            if self.dropped_messages:
+                lines.append(f"⚠️  Dropped messages (queue full): {self.dropped_messages}")
+            lines.append("="*70 + "\n\n")
+            
+            sys.stdout.write("\n".join(lines))
+            sys.stdout.flush()
+            last_render = time.time()
     
     def run(self):
         """Start the backend processor"""
         print("🚀 Starting Hygiene Score Backend Engine...")
         print(f"📡 Connecting to MQTT broker: {MQTT_BROKER}")
         
+        # Process managers stop services with SIGTERM; leave the loop so shutdown still flushes
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        
         self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        self.mqtt_client.loop_forever()
+        self.mqtt_client.loop_start()
+        
+        try:
+            while self.running:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+    
+    def handle_sigterm(self, signum, frame):
+        """Stop the main loop so run() shuts down cleanly"""
+        self.running = False
+    
+    def shutdown(self):
+        """Stop receiving and flush everything still queued"""
+        print("🛑 Stopping, flushing pending writes...")
+        self.running = False
+        self.mqtt_client.loop_stop()
+        
+        # Let workers finish their current batch, then process what they left queued
+        for thread in self._workers:
+            thread.join()
+        for inbound in self._inbound:
+            items = []
+            while True:
+                try:
+                    items.append(inbound.get_nowait())
+                except queue.Empty:
+                    break
+            for i in range(0, len(items), INBOUND_BATCH_SIZE):
+                self.process_inbound_items(items[i:i + INBOUND_BATCH_SIZE])
+        
+        # Wait for in-flight commits and alerts; failed commits requeue their logs
+        self._log_writer.join()
+        self._commit_pool.shutdown(wait=True)
+        self._notification_pool.shutdown(wait=True)
+        
+        items = []
+        while True:
+            try:
+                items.append(self._log_queue.get_nowait())
+            except queue.Empty:
+                break
+        for i in range(0, len(items), LOG_BATCH_SIZE):
+            failed = self.commit_log_batch(items[i:i + LOG_BATCH_SIZE])
+            if failed:
+                print(f"✗ Lost {len(failed)} hygiene logs at shutdown")
+        
+        self._rtdb_writer.join()
+        self.flush_realtime_db()
+        
+        if self._configs_dirty.is_set():
+            self.save_config_cache()
+        print("✓ Backend stopped")
 
 # Main execution
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+import os
+import random
+import sys
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import msgpack
+import numpy as np
+import orjson
+
+# main.py connects to Firebase and builds an MQTT client at import time; the
+# scoring engine needs neither, so stand-ins are registered before importing it.
+firebase_admin = types.ModuleType('firebase_admin')
+firebase_admin.initialize_app = lambda *args, **kwargs: None
+firebase_admin.credentials = types.SimpleNamespace(Certificate=lambda path: None)
+firebase_admin.firestore = types.SimpleNamespace(client=lambda: None)
+firebase_admin.db = types.SimpleNamespace(reference=lambda: None)
+paho_client = types.ModuleType('paho.mqtt.client')
+paho_client.Client = object
+sys.modules.setdefault('firebase_admin', firebase_admin)
+sys.modules.setdefault('paho', types.ModuleType('paho'))
+sys.modules.setdefault('paho.mqtt', types.ModuleType('paho.mqtt'))
+sys.modules.setdefault('paho.mqtt.client', paho_client)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+# The batch path computes the comfort bands branch-free and weights with a
+# matrix product, so it agrees with the scalar formulas only up to rounding:
+# component scores within 1e-9, weighted scores within one 0.01 rounding step.
+COMPONENT_TOLERANCE = 1e-9
+WEIGHTED_TOLERANCE = 0.01 + 1e-9
+
+
+class BatchScoringEquivalenceTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        self.readings = [{
+            'air_quality': rng.uniform(-10, 120),
+            'floor_moisture': rng.uniform(0, 120),
+            'humidity': rng.choice([rng.uniform(0, 100), rng.randint(0, 100), 40, 60]),
+            'temperature': rng.choice([rng.uniform(-5, 50), rng.randint(-5, 50), 20, 26]),
+            'footfall_count': rng.randint(0, 150)
+        } for _ in range(5000)]
+        self.data_array = np.array(
+            [[reading[field] for field, _ in main.SENSOR_DEFAULTS] for reading in self.readings],
+            dtype=np.float64)
+
+    def test_component_scores_match_scalar(self):
+        engine = main.ENGINES['public']
+        batch = engine.calculate_component_scores_batch(self.data_array)
+        for reading, row in zip(self.readings, batch):
+            expected = engine.calculate_component_scores(reading)
+            for i, component in enumerate(main.COMPONENTS):
+                self.assertAlmostEqual(row[i], expected[component], delta=COMPONENT_TOLERANCE)
+
+    def test_weighted_scores_match_scalar(self):
+        for profile, engine in main.ENGINES.items():
+            components = engine.calculate_component_scores_batch(self.data_array)
+            batch = engine.calculate_weighted_scores_batch(components)
+            for reading, score in zip(self.readings, batch):
+                expected = engine.calculate_weighted_score(engine.calculate_component_scores(reading))
+                self.assertAlmostEqual(score, expected, delta=WEIGHTED_TOLERANCE, msg=profile)
+
+    def test_time_decay_matches_scalar(self):
+        engine = main.ENGINES['public']
+        now = time.monotonic()
+        # Cleaning times as stored in last_cleaning_times; NaN means never cleaned
+        cleaned = [float('nan'), now, now - 1800, now - 3 * 3600, now - 20 * 3600]
+        base_scores = np.array([80.0, 80.0, 80.0, 80.0, 2.0])
+        hours = (time.monotonic() - np.array(cleaned)) / 3600
+        batch = engine.apply_time_decay_batch(base_scores, hours)
+        for base_score, last_cleaned, score in zip(base_scores, cleaned, batch):
+            expected = engine.apply_time_decay(float(base_score), last_cleaned)
+            self.assertAlmostEqual(score, expected, delta=WEIGHTED_TOLERANCE)
+
+
+
+def reference_anomalies(data, component_scores):
+    """detect_anomalies as written before the bitmask rewrite"""
+    anomalies = []
+    if data.get('air_quality', 0) > 70:
+        anomalies.append({'type': 'ODOR_SPIKE', 'severity': 'HIGH',
+                          'message': 'Severe odor/ammonia levels detected',
+                          'value': data.get('air_quality')})
+    if data.get('floor_moisture', 0) > 60:
+        anomalies.append({'type': 'MOISTURE_ALERT', 'severity': 'HIGH',
+                          'message': 'Wet floor or potential leakage detected',
+                          'value': data.get('floor_moisture')})
+    temp = data.get('temperature', 23)
+    if temp < 10 or temp > 35:
+        anomalies.append({'type': 'TEMPERATURE_ANOMALY', 'severity': 'MEDIUM',
+                          'message': f'Unusual temperature: {temp}°C', 'value': temp})
+    if data.get('footfall_count', 0) > 50 and component_scores.get('air_quality', 100) < 40:
+        anomalies.append({'type': 'HIGH_USAGE', 'severity': 'MEDIUM',
+                          'message': 'High usage detected, cleaning recommended',
+                          'value': data.get('footfall_count')})
+    return anomalies
+
+
+class DetectAnomaliesTest(unittest.TestCase):
+    def test_matches_reference(self):
+        rng = random.Random(7)
+        engine = main.ENGINES['public']
+        fields = (
+            ('air_quality', lambda: rng.choice([70, 71, rng.uniform(0, 100)])),
+            ('floor_moisture', lambda: rng.choice([60, 61, rng.uniform(0, 100)])),
+            ('temperature', lambda: rng.choice([9.5, 10, 35, 36, rng.randint(-5, 50)])),
+            ('footfall_count', lambda: rng.choice([50, 51, rng.randint(0, 100)]))
+        )
+        for _ in range(2000):
+            # Leave fields out at random so the defaults are exercised too
+            data = {field: value() for field, value in fields if rng.random() < 0.9}
+            component_scores = {'air_quality': rng.choice([39.9, 40, rng.uniform(0, 100)])}
+            self.assertEqual(engine.detect_anomalies(data, component_scores),
+                             reference_anomalies(data, component_scores), msg=data)
+
+    def test_all_rules_in_order(self):
+        data = {'air_quality': 90, 'floor_moisture': 80, 'temperature': 40, 'footfall_count': 60}
+        anomalies = main.ENGINES['public'].detect_anomalies(data, {'air_quality': 10})
+        self.assertEqual([a['type'] for a in anomalies],
+                         ['ODOR_SPIKE', 'MOISTURE_ALERT', 'TEMPERATURE_ANOMALY', 'HIGH_USAGE'])
+        self.assertEqual(anomalies[2]['message'], 'Unusual temperature: 40°C')
+
+
+def make_processor():
+    """A BackendProcessor without clients or threads, holding only realtime DB staging state"""
+    processor = main.BackendProcessor.__new__(main.BackendProcessor)
+    processor._rtdb_pending = {}
+    processor._rtdb_fields = {}
+    processor._last_full_states = {}
+    processor._rtdb_lock = threading.Lock()
+    return processor
+
+
+class DecodePayloadTest(unittest.TestCase):
+    def setUp(self):
+        self.processor = make_processor()
+
+    def test_json_full_keys(self):
+        payload = {'washroom_id': 'W1', 'air_quality': 42.5, 'footfall_count': 3}
+        self.assertEqual(self.processor.decode_payload(orjson.dumps(payload)), payload)
+
+    def test_json_compact_keys(self):
+        raw = orjson.dumps({'wid': 'W1', 'ty': 'heartbeat', 'uptime_ms': 10})
+        self.assertEqual(self.processor.decode_payload(raw),
+                         {'washroom_id': 'W1', 'type': 'heartbeat', 'uptime_ms': 10})
+
+    def test_msgpack_compact_keys(self):
+        raw = msgpack.packb({'wid': 'W2', 'aq': 60, 'fm': 20.5, 'hu': 45, 'te': 22, 'fc': 7})
+        self.assertEqual(self.processor.decode_payload(raw), {
+            'washroom_id': 'W2', 'air_quality': 60, 'floor_moisture': 20.5,
+            'humidity': 45, 'temperature': 22, 'footfall_count': 7
+        })
+
+    def test_msgpack_map16(self):
+        # More than 15 entries no longer fit a fixmap
+        payload = {f'extra_{i}': i for i in range(20)}
+        payload['wid'] = 'W3'
+        raw = msgpack.packb(payload)
+        self.assertEqual(raw[0], 0xde)
+        decoded = self.processor.decode_payload(raw)
+        self.assertEqual(decoded['washroom_id'], 'W3')
+        self.assertEqual(decoded['extra_19'], 19)
+
+
+class RecordingRealtimeDB:
+    """Stands in for the realtime DB reference, rejecting updates that touch a bad path"""
+    def __init__(self, bad_path=None):
+        self.bad_path = bad_path
+        self.updates = []
+
+    def update(self, values):
+        if self.bad_path is not None and any(path.startswith(self.bad_path) for path in values):
+            raise ValueError('rejected path')
+        self.updates.append(dict(values))
+
+
+class RealtimeStagingTest(unittest.TestCase):
+    def setUp(self):
+        self.processor = make_processor()
+
+    def flush(self, realtime_db):
+        with mock.patch.object(main, 'realtime_db', realtime_db), \
+                mock.patch('builtins.print'):
+            self.processor.flush_realtime_db()
+
+    def test_fields_alone_become_child_paths(self):
+        self.processor.queue_realtime_fields('washrooms/W1/current', {'score': 70.0, 'timestamp': 't1'})
+        realtime_db = RecordingRealtimeDB()
+        self.flush(realtime_db)
+        self.assertEqual(realtime_db.updates, [{
+            'washrooms/W1/current/score': 70.0,
+            'washrooms/W1/current/timestamp': 't1'
+        }])
+
+    def test_fields_fold_into_staged_full_write(self):
+        self.processor.queue_realtime_update('washrooms/W1/current', {
+            'score': 70.0, 'timestamp': 't1', 'component_scores': {}, 'anomalies': []
+        })
+        self.processor.queue_realtime_fields('washrooms/W1/current', {'score': 70.4, 'timestamp': 't2'})
+        realtime_db = RecordingRealtimeDB()
+        self.flush(realtime_db)
+        self.assertEqual(realtime_db.updates, [{'washrooms/W1/current': {
+            'score': 70.4, 'timestamp': 't2', 'component_scores': {}, 'anomalies': []
+        }}])
+
+    def test_full_write_replaces_staged_fields(self):
+        self.processor.queue_realtime_fields('washrooms/W1/current', {'score': 70.0, 'timestamp': 't1'})
+        self.processor.queue_realtime_update('washrooms/W1/current', {'score': 40.0, 'timestamp': 't2'})
+        realtime_db = RecordingRealtimeDB()
+        self.flush(realtime_db)
+        self.assertEqual(realtime_db.updates,
+                         [{'washrooms/W1/current': {'score': 40.0, 'timestamp': 't2'}}])
+
+    def test_rejected_path_does_not_block_others(self):
+        self.processor.queue_realtime_update('washrooms/W1/current', {'score': 70.0})
+        self.processor.queue_realtime_update('washrooms/W2/current', {'score': 60.0})
+        self.processor.queue_realtime_fields('washrooms/W3/current', {'score': 50.0})
+        self.processor._last_full_states['W1'] = (70.0, False)
+        realtime_db = RecordingRealtimeDB(bad_path='washrooms/W2')
+        self.flush(realtime_db)
+        self.assertEqual(realtime_db.updates, [
+            {'washrooms/W1/current': {'score': 70.0}},
+            {'washrooms/W3/current/score': 50.0}
+        ])
+        # The lost full write must be resent rather than reduced to a score-only update
+        self.assertEqual(self.processor._last_full_states, {})
+        self.assertEqual(self.processor._rtdb_pending, {})
+        self.assertEqual(self.processor._rtdb_fields, {})
+
+
+if __name__ == '__main__':
+    unittest.main()